@@ -1,12 +1,139 @@
 #__init__.py
 
+import asyncio
 import fitz  # PyMuPDF
-import json
 import logging
 import azure.functions as func
-import base64
-import traceback
+try:
+    import pybase64 as base64  # SIMD-accelerated drop-in for the stdlib module
+except ImportError:
+    import base64
+import hashlib
+import io
+import math
+import os
+import string
+import threading
+import cachetools
+import orjson
 import requests
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# URL downloads are read in chunks of this many bytes
+DOWNLOAD_CHUNK_SIZE = 65536
+# Raw text is split into artificial pages of at most this many characters
+RAW_TEXT_PAGE_SIZE = 5000
+# Every base64-encoded PDF starts with this, the encoding of "%PDF-"
+PDF_BASE64_MAGIC = "JVBERi0"
+# Characters allowed in base64, including the line breaks of wrapped (MIME/PEM) encodings
+BASE64_ALPHABET = frozenset(string.ascii_letters + string.digits + "+/=\r\n")
+# Number of leading characters checked against the base64 alphabet
+BASE64_PREFIX_CHECK = 80
+
+# Documents with at least this many pages are extracted in worker processes, if there is more than one
+PARALLEL_PAGE_THRESHOLD = 16
+PAGE_WORKERS = min(os.cpu_count() or 1, 4)
+# PyMuPDF's flags for plain-text extraction, named once for every page call
+TEXT_FLAGS = fitz.TEXTFLAGS_TEXT
+# Worker processes are only started on first use
+PAGE_POOL = ProcessPoolExecutor(max_workers=PAGE_WORKERS)
+PAGE_POOL_LOCK = threading.Lock()
+
+# Extracted pages of recently processed PDFs, keyed by content fingerprint and
+# bounded by their total number of characters rather than by entry count
+PDF_CACHE_MAX_CHARS = 32 * 1024 * 1024
+PDF_CACHE = cachetools.LRUCache(maxsize=PDF_CACHE_MAX_CHARS, getsizeof=lambda pages: sum(map(len, pages)))
+# cachetools caches are not thread-safe and requests may run concurrently
+PDF_CACHE_LOCK = threading.Lock()
+
+# Shared across invocations so repeated downloads reuse pooled connections
+HTTP_SESSION = requests.Session()
+HTTP_ADAPTER = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=Retry(total=2, backoff_factor=0.2))
+HTTP_SESSION.mount("https://", HTTP_ADAPTER)
+HTTP_SESSION.mount("http://", HTTP_ADAPTER)
+
+def is_base64_pdf(content):
+    """Checks the magic prefix to tell whether content claims to be a base64-encoded PDF."""
+    return isinstance(content, str) and content.startswith(PDF_BASE64_MAGIC)
+
+def has_base64_prefix(content):
+    """Cheaply checks that a short prefix uses only base64 characters."""
+    # Truncated or mis-padded input is left to b64decode, which rejects it with a ValueError
+    return all(c in BASE64_ALPHABET for c in content[:BASE64_PREFIX_CHECK])
+
+def pdf_fingerprint(pdf_bytes):
+    """Returns a content hash identifying the PDF for caching."""
+    # OpenSSL's SHA-256 uses the SHA-NI instructions on current Azure hosts and
+    # outruns BLAKE2b there; the hash is only a cache key, not a security control
+    return hashlib.sha256(pdf_bytes, usedforsecurity=False).digest()
+
+def extract_pages(pdf_document, start, end):
+    """Extracts the text of pages start to end-1 of an open PDF document.
+
+    Returns the page texts and the error messages of pages that failed, which the
+    caller logs because records from worker processes never reach the host.
+    """
+    pages = [None] * (end - start)
+    errors = []
+    # Bind the method once so the loop does a local lookup instead of an attribute lookup
+    load_page = pdf_document.load_page
+    for index, page_num in enumerate(range(start, end)):
+        try:
+            page = load_page(page_num)
+            # Build the TextPage directly rather than through get_text's option dispatch
+            textpage = page.get_textpage(flags=TEXT_FLAGS)
+            text = textpage.extractText()
+            del textpage
+            # Limit text size per page to avoid overloading
+            if len(text) > 100000:
+                text = text[:100000]
+                text += "... [content truncated]"
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Extracted text from page %d, length: %d", page_num + 1, len(text))
+            pages[index] = text
+        except Exception as page_error:
+            errors.append(f"Error extracting page {page_num}: {str(page_error)}")
+            pages[index] = f"[Error extracting page {page_num+1}: {str(page_error)}]"
+    return pages, errors
+
+def extract_page_range(pdf_bytes, start, end):
+    """Opens the PDF in a worker process and extracts a contiguous block of pages."""
+    # PyMuPDF documents cannot be shared between processes, so each worker opens its own
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf_document:
+        return extract_pages(pdf_document, start, end)
+
+def replace_page_pool(broken_pool):
+    """Swaps in a fresh worker pool after a worker process died."""
+    global PAGE_POOL
+    with PAGE_POOL_LOCK:
+        if PAGE_POOL is broken_pool:
+            PAGE_POOL = ProcessPoolExecutor(max_workers=PAGE_WORKERS)
+    broken_pool.shutdown(wait=False)
+
+def extract_pages_in_pool(pdf_bytes, max_pages):
+    """Extracts pages in the worker pool, replacing the pool if a worker died."""
+    pool = PAGE_POOL
+    # One contiguous block per worker, so pdf_bytes is pickled and opened once per worker
+    block_size = math.ceil(max_pages / PAGE_WORKERS)
+    starts = range(0, max_pages, block_size)
+    ends = [min(start + block_size, max_pages) for start in starts]
+    try:
+        blocks = list(pool.map(partial(extract_page_range, pdf_bytes), starts, ends))
+    except BrokenProcessPool:
+        # A worker was killed (e.g. out of memory, or a MuPDF crash on this PDF). Without a new
+        # pool every later PDF would fail, but this one is not retried in the host process,
+        # where the same crash would take down every running invocation
+        replace_page_pool(pool)
+        raise
+    pages = [text for block_pages, _ in blocks for text in block_pages]
+    errors = [error for _, block_errors in blocks for error in block_errors]
+    return pages, errors
 
 def process_pdf(pdf_bytes):
     """Splits a PDF into pages and extracts text."""
@@ -14,101 +141,119 @@ def process_pdf(pdf_bytes):
         # First check if we have enough data
         if len(pdf_bytes) < 100:
             return None, "PDF data too small to be valid"
+        
+        # Re-indexing the same blob sends identical bytes, so reuse the earlier result
+        cache_key = pdf_fingerprint(pdf_bytes)
+        with PDF_CACHE_LOCK:
+            cached_pages = PDF_CACHE.get(cache_key)
+        if cached_pages is not None:
+            logger.warning(f"Using cached text for PDF with {len(cached_pages)} pages")
+            return cached_pages, None
             
         # Try to open the PDF with additional error handling
         try:
             pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
         except Exception as e:
-            logging.error(f"Failed to open PDF: {str(e)}")
+            logger.error(f"Failed to open PDF: {str(e)}")
             return None, f"Cannot open PDF document: {str(e)}"
         
         total_page_count = len(pdf_document)
-        logging.warning(f"Successfully processed PDF with {total_page_count} pages")
+        logger.warning(f"Successfully processed PDF with {total_page_count} pages")
         
         # Handle very large documents by limiting pages
         max_pages = min(total_page_count, 300)  # Process up to 300 pages
         
-        pages = []
-        for page_num in range(max_pages):
+        # With a single worker the pool only adds a process hop and pickling
+        if PAGE_WORKERS > 1 and max_pages >= PARALLEL_PAGE_THRESHOLD:
             try:
-                page = pdf_document.load_page(page_num)
-                text = page.get_text("text")
-                # Limit text size per page to avoid overloading
-                if len(text) > 100000:
-                    text = text[:100000] + "... [content truncated]"
-                logging.warning(f"Extracted text from page {page_num + 1}, length: {len(text)}")
-                pages.append(text)
-            except Exception as page_error:
-                logging.error(f"Error extracting page {page_num}: {str(page_error)}")
-                pages.append(f"[Error extracting page {page_num+1}: {str(page_error)}]")
+                pages, errors = extract_pages_in_pool(pdf_bytes, max_pages)
+            except BrokenProcessPool:
+                logger.error("Page extraction worker crashed")
+                return None, "Page extraction worker crashed"
+        else:
+            pages, errors = extract_pages(pdf_document, 0, max_pages)
+        for error in errors:
+            logger.error(error)
         
+        # Page failures may be transient, so only fully extracted documents are cached
+        if not errors and PDF_CACHE.getsizeof(pages) <= PDF_CACHE_MAX_CHARS:
+            with PDF_CACHE_LOCK:
+                PDF_CACHE[cache_key] = pages
         return pages, None
     except Exception as e:
-        error_details = traceback.format_exc()
-        logging.error(f"Error processing PDF: {str(e)}\n{error_details}")
+        logger.exception("Error processing PDF: %s", e)
         return None, f"Error processing PDF: {str(e)}"
 
 def process_skillset_content(content, record_id):
     """Process content from the skillset."""
     try:
         # Log content type and length for debugging
-        logging.warning(f"Processing content of type {type(content)}, length: {len(content) if content else 0}")
+        logger.warning(f"Processing content of type {type(content)}, length: {len(content) if content else 0}")
         
         # Check if content is a URL/path (from metadata_storage_path)
         if isinstance(content, str) and (content.startswith("http") or content.startswith("https")):
-            logging.warning(f"Content appears to be a URL: {content}")
+            logger.warning(f"Content appears to be a URL: {content}")
             try:
                 # Download the file from the URL
-                response = requests.get(content, timeout=30)
-                if response.status_code == 200:
-                    pdf_bytes = response.content
-                    logging.warning(f"Successfully downloaded {len(pdf_bytes)} bytes from URL")
-                    return process_pdf(pdf_bytes)
-                else:
-                    return None, f"Failed to download from URL: status code {response.status_code}"
+                with HTTP_SESSION.get(content, timeout=30, stream=True) as response:
+                    if response.status_code != 200:
+                        return None, f"Failed to download from URL: status code {response.status_code}"
+                    # Unlike response.content, this never holds the chunks and a joined copy at once
+                    buf = io.BytesIO()
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        buf.write(chunk)
+                pdf_bytes = buf.getvalue()
+                logger.warning(f"Successfully downloaded {len(pdf_bytes)} bytes from URL")
+                return process_pdf(pdf_bytes)
             except Exception as e:
-                logging.error(f"Error downloading from URL: {str(e)}")
+                logger.error(f"Error downloading from URL: {str(e)}")
                 return None, f"Error downloading from URL: {str(e)}"
                 
-        # Check if content is base64 (typical for Azure AI Search)
-        try:
-            pdf_bytes = base64.b64decode(content)
-            logging.warning(f"Successfully decoded base64, {len(pdf_bytes)} bytes")
+        # Check if content is a base64-encoded PDF (typical for Azure AI Search)
+        if is_base64_pdf(content):
+            # Content with the PDF prefix is never raw text, so a bad payload is an error
+            if not has_base64_prefix(content):
+                return None, "Malformed base64 PDF: invalid characters"
+            try:
+                pdf_bytes = base64.b64decode(content, validate=False)
+            except ValueError as e:
+                return None, f"Malformed base64 PDF: {str(e)}"
+            logger.warning(f"Successfully decoded base64, {len(pdf_bytes)} bytes")
             return process_pdf(pdf_bytes)
-        except:
-            # If not base64 or URL, treat as raw text
-            logging.warning(f"Content is not base64 or URL, treating as raw text")
-            
-            # Just return the content split by newlines or chunks as "pages"
-            if content and isinstance(content, str):
-                lines = content.split("\n")
-                pages = []
-                current_page = ""
-                for line in lines:
-                    current_page += line + "\n"
-                    if len(current_page) > 5000:  # Create artificial pages of ~5000 chars
-                        pages.append(current_page)
-                        current_page = ""
-                if current_page:
-                    pages.append(current_page)
-                logging.warning(f"Split raw text into {len(pages)} pages")
-                return pages, None
-            else:
-                return None, "Invalid or empty content"
+        
+        # If not base64 or URL, treat as raw text
+        logger.warning(f"Content is not base64 or URL, treating as raw text")
+        
+        # Just return the content split by newlines or chunks as "pages"
+        if content and isinstance(content, str):
+            # Slice artificial pages of up to RAW_TEXT_PAGE_SIZE chars, ending on a newline where possible
+            pages = []
+            start, length = 0, len(content)
+            while start < length:
+                end = min(start + RAW_TEXT_PAGE_SIZE, length)
+                if end < length:
+                    newline = content.rfind("\n", start, end)
+                    if newline > start:
+                        end = newline + 1
+                pages.append(content[start:end])
+                start = end
+            logger.warning(f"Split raw text into {len(pages)} pages")
+            return pages, None
+        else:
+            return None, "Invalid or empty content"
                 
     except Exception as e:
-        error_details = traceback.format_exc()
-        logging.error(f"Error processing content: {str(e)}\n{error_details}")
+        logger.exception("Error processing content: %s", e)
         return None, f"Error processing content: {str(e)}"
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
+async def main(req: func.HttpRequest) -> func.HttpResponse:
     """Azure Function HTTP Trigger to process PDF and return pages."""
-    logging.warning("Received request to split PDF")
+    logger.warning("Received request to split PDF")
     
     try:
         # Log headers for debugging
-        for header_name, header_value in req.headers.items():
-            logging.info(f"Header: {header_name}={header_value}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Headers: %r", dict(req.headers))
             
         # Check if this is a skillset request (JSON) or direct PDF upload
         content_type = req.headers.get('Content-Type', '')
@@ -116,19 +261,20 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         if 'application/json' in content_type:
             # Handle skillset request
             try:
-                request_json = req.get_json()
-                logging.warning(f"Skillset request received: {json.dumps(request_json)[:500]}...")
+                # orjson.JSONDecodeError is a ValueError, so malformed JSON still lands below
+                request_json = orjson.loads(req.get_body())
             except ValueError:
-                logging.error("Invalid JSON in request")
-                return func.HttpResponse(
-                    json.dumps({"values": [{"recordId": "0", "errors": ["Invalid JSON in request"]}]}),
-                    mimetype="application/json",
+                logger.error("Invalid JSON in request")
+                return json_response(
+                    {"values": [{"recordId": "0", "errors": ["Invalid JSON in request"]}]},
                     status_code=400
                 )
             
             if 'values' in request_json and len(request_json['values']) > 0:
                 values = request_json['values']
                 record_id = values[0].get('recordId', '0')
+                # Summarize rather than dump the body, which can hold megabytes of base64
+                logger.warning("Skillset request received with %d values, first recordId: %s", len(values), record_id)
                 
                 # Check if data and content exist
                 if 'data' not in values[0]:
@@ -139,7 +285,9 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                     return create_error_response(record_id, "No content provided in request")
                 
                 # Use the enhanced content processing function
-                pages, error = process_skillset_content(content, record_id)
+                # Downloading and extraction block, so run them off the event loop
+                loop = asyncio.get_running_loop()
+                pages, error = await loop.run_in_executor(None, process_skillset_content, content, record_id)
                 
                 if error:
                     return create_error_response(record_id, error)
@@ -156,34 +304,31 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                     ]
                 }
                 
-                logging.warning("Successfully created skillset response")
-                return func.HttpResponse(
-                    json.dumps(response),
-                    mimetype="application/json"
-                )
+                logger.warning("Successfully created skillset response")
+                return json_response(response)
             else:
                 # Ensure response follows required format even for errors
-                return func.HttpResponse(
-                    json.dumps({
+                return json_response(
+                    {
                         "values": [
                             {
                                 "recordId": "0",
                                 "errors": ["Invalid request format: missing 'values' array"]
                             }
                         ]
-                    }),
-                    mimetype="application/json",
+                    },
                     status_code=400
                 )
         else:
             # Direct PDF processing
             pdf_bytes = req.get_body()
-            logging.warning(f"Received direct PDF with {len(pdf_bytes)} bytes")
+            logger.warning(f"Received direct PDF with {len(pdf_bytes)} bytes")
             
             if len(pdf_bytes) == 0:
                 return func.HttpResponse("No PDF data received in request body.", status_code=400)
             
-            pages, error = process_pdf(pdf_bytes)
+            loop = asyncio.get_running_loop()
+            pages, error = await loop.run_in_executor(None, process_pdf, pdf_bytes)
             
             if error:
                 return func.HttpResponse(f"Error: {error}", status_code=500)
@@ -193,31 +338,36 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 "pages": [{"page_number": i+1, "content": content} for i, content in enumerate(pages)]
             }
             
-            return func.HttpResponse(
-                json.dumps(result),
-                mimetype="application/json"
-            )
+            return json_response(result)
     except Exception as e:
-        error_details = traceback.format_exc()
-        logging.error(f"General error: {str(e)}\n{error_details}")
+        logger.exception("General error: %s", e)
         
         # Always return response in the format expected by the skill
-        return func.HttpResponse(
-            json.dumps({
+        return json_response(
+            {
                 "values": [
                     {
                         "recordId": "0",
                         "errors": [f"General function error: {str(e)}"]
                     }
                 ]
-            }),
-            mimetype="application/json",
+            },
             status_code=500
         )
 
+def json_response(payload, status_code=200):
+    """Serializes the payload into a JSON HTTP response with an explicit Content-Length."""
+    body = orjson.dumps(payload)
+    return func.HttpResponse(
+        body,
+        mimetype="application/json",
+        status_code=status_code,
+        headers={"Content-Length": str(len(body))}
+    )
+
 def create_error_response(record_id, error_message):
     """Creates an error response in the format expected by Azure AI Search skillsets."""
-    logging.error(f"Creating error response: {error_message}")
+    logger.error(f"Creating error response: {error_message}")
     response = {
         "values": [
             {
@@ -226,7 +376,4 @@ def create_error_response(record_id, error_message):
             }
         ]
     }
-    return func.HttpResponse(
-        json.dumps(response),
-        mimetype="application/json"
-    )
\ No newline at end of file
+    return json_response(response)
\ No newline at end of file